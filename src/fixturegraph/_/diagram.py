@@ -1,11 +1,16 @@
 from collections import defaultdict
 from collections.abc import Sequence
-from dataclasses import asdict, field, dataclass
-from typing import Dict, List, Optional, Set, Tuple
+from dataclasses import field, dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+import functools
+import hashlib
 import inspect
+import os
 import re
+import shutil
 import subprocess
 import tempfile
+import time
 import typing
 
 
@@ -25,12 +30,26 @@ def filter_out_synonymous_attributes(synonymous_attrs, entity, attrs):
 
 
 def is_sequence_of_strings(value):
-    return not isinstance(value, str) and isinstance(value, Sequence) and all(
-        isinstance(x, str) for x in value)
+    # Sequences are assumed to be homogeneous, so only the first item is
+    # checked: a long list of objects that aren't strings is rejected without
+    # walking all of it.
+    if isinstance(value, (str, bytes)) or not isinstance(value, Sequence):
+        return False
+    return len(value) != 0 and isinstance(value[0], str)
+
+
+_namedtuple_types: Dict[type, bool] = {}
 
 
 def isnamedtupleinstance(x):
     t = type(x)
+    result = _namedtuple_types.get(t)
+    if result is None:
+        result = _namedtuple_types[t] = isnamedtupletype(t)
+    return result
+
+
+def isnamedtupletype(t):
     b = t.__bases__
     if len(b) != 1 or b[0] != tuple:
         return False
@@ -40,21 +59,61 @@ def isnamedtupleinstance(x):
     return all(type(n) == str for n in f)
 
 
+_property_names: Dict[type, List[str]] = {}
+
+
+def property_names(t):
+    # Names of the properties visible on instances of t, walking the MRO so
+    # that an attribute in a subclass shadows a property of the same name in
+    # a base class.
+    names = _property_names.get(t)
+    if names is None:
+        seen = set()
+        names = []
+        for klass in t.__mro__:
+            for name, value in vars(klass).items():
+                if name in seen:
+                    continue
+                seen.add(name)
+                if isinstance(value, property):
+                    names.append(name)
+        _property_names[t] = names
+    return names
+
+
+def iter_members(entity):
+    # Looking only at the instance's own fields and its class's properties is
+    # much cheaper than inspect.getmembers, which getattrs everything in
+    # dir(entity).  Sorted by name like getmembers, so that the choice of
+    # representative among synonymous attributes doesn't change.
+    if isnamedtupleinstance(entity):
+        members = dict(zip(type(entity)._fields, entity))
+    else:
+        instance_dict = getattr(entity, "__dict__", None)
+        if not instance_dict:
+            return inspect.getmembers(entity, lambda a: not inspect.isroutine(a))
+        members = dict(instance_dict)
+    for name in property_names(type(entity)):
+        try:
+            members[name] = getattr(entity, name)
+        except AttributeError:
+            continue
+    return sorted(members.items())
+
+
 def get_attrs(synonymous_attrs, entity):
     attrs = {}
-    is_namedtuple = isnamedtupleinstance(entity)
-    for k, v in inspect.getmembers(entity, lambda a: not inspect.isroutine(a)):
+    for k, v in iter_members(entity):
         if k.startswith("__"):
             continue
-        if is_namedtuple and k == "_fields":
-            continue
 
         if isinstance(v, str):
             attrs[k.lstrip("_")] = v
         if is_sequence_of_strings(v):
             base = k.lstrip("_")
             for i, item in enumerate(v):
-                attrs[f"{base}_{i}"] = item
+                if isinstance(item, str):
+                    attrs[f"{base}_{i}"] = item
     return filter_out_synonymous_attributes(synonymous_attrs, entity, attrs.items())
 
 
@@ -69,24 +128,61 @@ def get_children(attrs, entity):
             yield name, value
 
 
-def entity_name(id_attrs, entity):
-    type_ = type(entity)
-    attr = getattr(entity, id_attrs[type_])
-    if callable(attr):
-        value = attr()
-    else:
-        value = attr
+def join_id(value):
     if isinstance(value, tuple):
-        value = "_".join(value)
-    return str(type_.__name__) + "_" + value
+        return "_".join(value)
+    return value
+
+
+def make_entity_namer(type_, id_attr):
+    # Whether the id is a getter method or a plain attribute is decided once
+    # per type here where the class says which it is, rather than for every
+    # entity.
+    prefix = str(type_.__name__) + "_"
+    class_attr = getattr(type_, id_attr, None)
+    if inspect.isroutine(class_attr):
+        return lambda entity: prefix + join_id(getattr(entity, id_attr)())
+    if class_attr is not None:
+        return lambda entity: prefix + join_id(getattr(entity, id_attr))
+
+    # Only set on instances, which may hold a getter too.
+    def name(entity):
+        value = getattr(entity, id_attr)
+        if callable(value):
+            value = value()
+        return prefix + join_id(value)
+
+    return name
+
+
+def make_entity_namers(id_attrs) -> Dict[type, Callable[[object], str]]:
+    return {type_: make_entity_namer(type_, attr) for type_, attr in id_attrs.items()}
+
+
+def make_name_of(id_attrs, entities) -> Callable[[object], str]:
+    # Entities are often named more than once, e.g. as a node and again as the
+    # child in a python reference, so work their names out once up front.
+    # Only members of entities are cached: they stay alive for the whole
+    # diagram, so their ids can't be reused.  Other children may be temporary
+    # (e.g. built afresh by a property), and a later object could reuse a
+    # freed one's id, so their names are always worked out afresh.
+    namers = make_entity_namers(id_attrs)
+    names_by_entity_id = {id(e): namers[type(e)](e) for e in entities}
+
+    def name_of(entity):
+        name = names_by_entity_id.get(id(entity))
+        if name is None:
+            name = namers[type(entity)](entity)
+        return name
+
+    return name_of
 
 
 class Node(typing.NamedTuple):
     name: str
 
 
-@dataclass(order=True, eq=True, frozen=True)
-class Arrow:
+class Arrow(typing.NamedTuple):
     src_name: str
     dst_name: str
     key: str
@@ -95,18 +191,26 @@ class Arrow:
     src_type: type
     dst_type: type
 
-    def __post_init__(self):
-        assert self.guessed == (self.value is not None), (self.guessed, self.value)
+    @classmethod
+    def make(cls, *, src_name, dst_name, key, value, guessed, src_type, dst_type):
+        assert guessed == (value is not None), (guessed, value)
+        return Arrow(src_name=src_name,
+                     dst_name=dst_name,
+                     key=key,
+                     value=value,
+                     guessed=guessed,
+                     src_type=src_type,
+                     dst_type=dst_type)
 
     def __str__(self):
         if self.value is not None:
-            return (
-                "{src_name} ({src_type.__name__}) -> {dst_name} ({dst_type.__name__}) "  # noqa
-                "on attr {key} matched on {value}").format(**asdict(self))
+            return (f"{self.src_name} ({self.src_type.__name__}) -> "
+                    f"{self.dst_name} ({self.dst_type.__name__}) "
+                    f"on attr {self.key} matched on {self.value}")
         else:
-            return (
-                "{src_name} ({src_type.__name__}) -> {dst_name} ({dst_type.__name__}) "  # noqa
-                "on attr {key}").format(**asdict(self))
+            return (f"{self.src_name} ({self.src_type.__name__}) -> "
+                    f"{self.dst_name} ({self.dst_type.__name__}) "
+                    f"on attr {self.key}")
 
 
 class DotArrow(typing.NamedTuple):
@@ -134,13 +238,17 @@ def write_dot(fh, lines):
     fh.write("}\n")
 
 
+_SLUG_TRANS = str.maketrans({" ": "_", "-": "_", ".": "_", "/": "_"})
+_RE_NON_WORD = re.compile(r"\W")
+_RE_WS = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=None)
 def slugify(s):
-    s = s.lower()
-    for c in [" ", "-", ".", "/"]:
-        s = s.replace(c, "_")
-    s = re.sub(r"\W", "", s)
+    s = s.lower().translate(_SLUG_TRANS)
+    s = _RE_NON_WORD.sub("", s)
     s = s.replace("_", " ")
-    s = re.sub(r"\s+", " ", s)
+    s = _RE_WS.sub(" ", s)
     s = s.strip()
     return s.replace(" ", "_")
 
@@ -152,65 +260,93 @@ class Configuration:
     synonymous_attrs: Dict[type, List[str]] = field(default_factory=dict)
 
 
-def make_guessed_arrows_from_attr_string_values(config, entities) -> List[Arrow]:
-    attrs_by_entity_name = {}
-    types_by_entity_name = {}
-    by_value: Dict[str, Set[str]] = {}
-    for entity in entities:
-        name = entity_name(config.id_attrs, entity)
-        attrs = get_attrs(config.synonymous_attrs, entity)
-        attrs_by_entity_name[name] = attrs
-        types_by_entity_name[name] = type(entity)
-        for k, v in attrs:
-            by_value.setdefault(v, set()).add(name)
-
-    attrs_: Dict[Tuple[type, str, type, str], Set[Tuple[str, str]]] = {}
-    for src_name, src_attrs in attrs_by_entity_name.items():
-        src_type = types_by_entity_name[src_name]
-        for k, v in src_attrs:
-            dst_names = set(by_value.get(v, []))
-            dst_names.discard(src_name)
-            for dst_name in dst_names:
-                dst_type = types_by_entity_name[dst_name]
-                attrs_.setdefault((src_type, src_name, dst_type, dst_name), set()).add(
-                    (k, v))
-
+def make_guessed_arrows_from_attr_string_values(by_value, types_by_entity_name,
+                                                slugs_by_entity_name) -> List[Arrow]:
+    # Join on value: only entities that share a value are ever visited, so the
+    # work done is proportional to the number of arrows actually produced.  An
+    # entity with several attributes holding the same value appears more than
+    # once in a bucket, so each attribute is paired with the distinct entities
+    # in the bucket rather than with every entry in it.  Entities that happen
+    # to share a name can still produce the same arrow twice, hence the check
+    # against arrows already emitted.
+    seen: Set[Tuple[str, str, str, str]] = set()
     arrows = []
-    for (src_type, src_name, dst_type, dst_name), attrs in attrs_.items():
-        for k, v in attrs:
-            arrows.append(
-                Arrow(
-                    src_type=src_type,
-                    src_name=slugify(src_name),
-                    dst_type=dst_type,
-                    dst_name=slugify(dst_name),
-                    key=k,
-                    value=v,
-                    guessed=True,
-                ))
+    for v, pairs in by_value.items():
+        names = dict.fromkeys(name for name, _ in pairs)
+        if len(names) < 2:
+            continue
+        for src_name, k in pairs:
+            for dst_name in names:
+                if dst_name == src_name:
+                    continue
+                edge = (src_name, dst_name, k, v)
+                if edge in seen:
+                    continue
+                seen.add(edge)
+                arrows.append(
+                    Arrow.make(
+                        src_type=types_by_entity_name[src_name],
+                        src_name=slugs_by_entity_name[src_name],
+                        dst_type=types_by_entity_name[dst_name],
+                        dst_name=slugs_by_entity_name[dst_name],
+                        key=k,
+                        value=v,
+                        guessed=True,
+                    ))
 
     return arrows
 
 
-def make_arrows_from_python_refs(config, entities) -> List[Arrow]:
-    arrows = []
+def make_arrows(config, entities, name_of=None) -> List[Arrow]:
+    # Walk entities just once, computing each entity's name and slug a single
+    # time and collecting both the value index used to guess arrows and the
+    # arrows from explicit python references.
+    if name_of is None:
+        name_of = make_name_of(config.id_attrs, entities)
+    types_by_entity_name = {}
+    slugs_by_entity_name = {}
+    by_value: Dict[str, List[Tuple[str, str]]] = {}
+    ref_arrows = []
+    seen_refs: Set[Tuple[str, str, str]] = set()
     for entity in entities:
+        name = name_of(entity)
+        slug = slugify(name)
+        type_ = type(entity)
+        types_by_entity_name[name] = type_
+        slugs_by_entity_name[name] = slug
+        for k, v in get_attrs(config.synonymous_attrs, entity):
+            by_value.setdefault(v, []).append((name, k))
         for attr_name, child in get_children(config.attrs_with_child_refs, entity):
-            parent_name = entity_name(config.id_attrs, entity)
-            child_name = entity_name(config.id_attrs, child)
-            arrows.append(
-                Arrow(
-                    src_type=type(entity),
-                    src_name=slugify(parent_name),
+            child_name = name_of(child)
+            ref = (name, child_name, attr_name)
+            if ref in seen_refs:
+                continue
+            seen_refs.add(ref)
+            ref_arrows.append(
+                Arrow.make(
+                    src_type=type_,
+                    src_name=slug,
                     dst_type=type(child),
                     dst_name=slugify(child_name),
                     key=attr_name,
                     value=None,
                     guessed=False,
                 ))
+
+    arrows = make_guessed_arrows_from_attr_string_values(by_value,
+                                                         types_by_entity_name,
+                                                         slugs_by_entity_name)
+    arrows.extend(ref_arrows)
     return arrows
 
 
+def undirected_edge(arrow):
+    # A canonically ordered pair is cheaper to build and hash than a frozenset.
+    if arrow.src_name <= arrow.dst_name:
+        return (arrow.src_name, arrow.dst_name)
+    return (arrow.dst_name, arrow.src_name)
+
+
 class Index:
 
     def __init__(
@@ -225,7 +361,11 @@ class Index:
     def grouped_by_undirected_edge_and_value(self, arrows):
         ungrouped = set(arrows)
         groups = []
-        for names, group in self._by_undirected_src_dst_name_pairs.items():
+        # Only look at the buckets the given arrows fall into, not every bucket
+        # in the index.
+        relevant = {undirected_edge(a) for a in arrows}
+        for names in relevant:
+            group = self._by_undirected_src_dst_name_pairs.get(names, frozenset())
             matching = group & ungrouped
             ungrouped -= matching
             if len(matching) != 0:
@@ -244,7 +384,7 @@ def make_index(arrows: List[Arrow]) -> Index:
     by_undirected_src_dst_name_pairs = defaultdict(set)
     for a in arrows:
         by_src_dst_name_pairs[(a.src_name, a.dst_name)].add(a)
-        by_undirected_src_dst_name_pairs[frozenset([a.src_name, a.dst_name])].add(a)
+        by_undirected_src_dst_name_pairs[undirected_edge(a)].add(a)
     return Index(by_src_dst_name_pairs=by_src_dst_name_pairs,
                  by_undirected_src_dst_name_pairs=by_undirected_src_dst_name_pairs)
 
@@ -254,13 +394,10 @@ def combine_arrows(arrows_: List[Arrow]) -> List[DotArrow]:
     r = []
 
     def make_label(arrows):
-        keys = set(a.key for a in arrows)
-        return "<br/>".join(slugify(k) for k in sorted(keys))
+        return "<br/>".join(slugify(k) for k in sorted({a.key for a in arrows}))
 
-    arrows = set(arrows_)
-
-    guessed = set(a for a in arrows if a.guessed)
-    not_guessed = arrows - guessed
+    guessed = set(a for a in arrows_ if a.guessed)
+    not_guessed = [a for a in arrows_ if not a.guessed]
 
     # Combine arrows that were guessed based on values, where they share the
     # same value.
@@ -269,7 +406,7 @@ def combine_arrows(arrows_: List[Arrow]) -> List[DotArrow]:
         label = make_label(group)
         r.append(DotArrow.make(src=name1, dst=name2, label=label, bidirectional=True))
 
-    arrows |= not_guessed
+    arrows.update(not_guessed)
 
     # Combine remaining arrows if they share a directed edge.
     for (src_name, dst_name), group in index.grouped_by_directed_edge(arrows):
@@ -280,44 +417,134 @@ def combine_arrows(arrows_: List[Arrow]) -> List[DotArrow]:
     return r
 
 
-def make_arrows(config, entities) -> List[Arrow]:
-    arrows = []
-    arrows.extend(make_guessed_arrows_from_attr_string_values(config, entities))
-    arrows.extend(make_arrows_from_python_refs(config, entities))
-    return arrows
+def dot_arrow_sort_key(arrow):
+    return (arrow.src, arrow.dst, arrow.label or "", arrow.bidirectional)
 
 
-def render_to_dot(nodes: List[Node], arrows: List[DotArrow]) -> List[str]:
+def render_to_dot(nodes: List[Node], arrows: List[DotArrow]) -> Iterator[str]:
     node_names = set()
     for node in nodes:
         node_names.add(node.name)
-    dot = []
-    for name in sorted(node_names):
-        dot.append(name)
-    for arrow in sorted(arrows):
+    yield from sorted(node_names)
+    for arrow in sorted(arrows, key=dot_arrow_sort_key):
         if arrow.label is None:
             if arrow.bidirectional:
-                dot.append(f'{arrow.src}->{arrow.dst} [ dir="both"]')
+                yield f'{arrow.src}->{arrow.dst} [ dir="both"]'
             else:
-                dot.append(f"{arrow.src}->{arrow.dst}")
+                yield f"{arrow.src}->{arrow.dst}"
         else:
             if arrow.bidirectional:
-                dot.append(
-                    f'{arrow.src}->{arrow.dst} [ label= <{arrow.label}> dir="both" ]')
+                yield f'{arrow.src}->{arrow.dst} [ label= <{arrow.label}> dir="both" ]'
             else:
-                dot.append(f"{arrow.src}->{arrow.dst} [ label= <{arrow.label}> ]")
-    return dot
+                yield f"{arrow.src}->{arrow.dst} [ label= <{arrow.label}> ]"
 
 
-def make_nodes(config, entities):
-    return [Node(slugify(entity_name(config.id_attrs, entity))) for entity in entities]
+def make_nodes(entities, name_of):
+    return [Node(slugify(name_of(entity))) for entity in entities]
 
 
-def diagram(config, entities):
-    arrows = make_arrows(config, entities)
+def diagram(config, entities) -> List[str]:
+    name_of = make_name_of(config.id_attrs, entities)
+    arrows = make_arrows(config, entities, name_of)
     dot_arrows = combine_arrows(arrows)
-    nodes = make_nodes(config, entities)
-    return render_to_dot(nodes, dot_arrows)
+    nodes = make_nodes(entities, name_of)
+    return list(render_to_dot(nodes, dot_arrows))
+
+
+# How long a rendered diagram is kept in the cache, in seconds.
+SVG_CACHE_TTL = 4 * 7 * 24 * 60 * 60
+
+
+def svg_cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "fixturegraph")
+
+
+def dot_source_hash(dot):
+    h = hashlib.blake2b(digest_size=16)
+    for line in dot:
+        h.update(line.encode())
+        h.update(b"\n")
+    return h.hexdigest()
+
+
+def is_fresh(path, ttl):
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return False
+    return time.time() - mtime < ttl
+
+
+def prune_svg_cache(cache_dir, ttl):
+    # Entries are keyed on content, so nothing else ever expires them: remove
+    # the old ones here so the TTL bounds how much disk the cache uses.
+    now = time.time()
+    try:
+        entries = list(os.scandir(cache_dir))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_file() and now - entry.stat().st_mtime >= ttl:
+                os.remove(entry.path)
+        except OSError:
+            continue
+
+
+def store_in_svg_cache(rendered_path, path):
+    # Returns the path of the cached copy, or None if the cache can't be
+    # written to.  The copy goes to a temporary name first so that a reader
+    # never sees a partly written SVG.
+    cache_dir = os.path.dirname(path)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        prune_svg_cache(cache_dir, SVG_CACHE_TTL)
+        shutil.copyfile(rendered_path, tmp_path)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return None
+    return path
+
+
+def render_svg(dot, path):
+    # Returns None on success, or an error message if dot failed.
+    try:
+        dot_proc = subprocess.Popen(["dot", "-Tsvg", "-o", path],
+                                    stdin=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    text=True)
+    except OSError as exc:
+        return str(exc)
+    assert dot_proc.stdin is not None
+    try:
+        write_dot(dot_proc.stdin, dot)
+    except BrokenPipeError:
+        pass
+    _, stderr = dot_proc.communicate()
+    if dot_proc.returncode != 0:
+        return stderr
+    return None
+
+
+def display_svg(path):
+    try:
+        child = subprocess.run(["display", path], capture_output=True, text=True)
+    except OSError as exc:
+        print(f"Failed to run display on {path}:")
+        print(exc)
+        return
+    if child.returncode != 0:
+        print(f"Failed to run display on {path}:")
+        print("display stdout:")
+        print(child.stdout)
+        print("display stderr:")
+        print(child.stderr)
 
 
 def show_diagram(config: Configuration, entities: List[object]):
@@ -326,15 +553,23 @@ def show_diagram(config: Configuration, entities: List[object]):
         print("Found no relations, not showing dot graph")
         return
 
-    path = tempfile.mktemp(suffix=".dot")
-    with open(path, "w") as fh:
-        write_dot(fh, dot)
-    child = subprocess.run(["bash", "-c", f"dot -Tsvg {path} | display"],
-                           capture_output=True)
-    if child.returncode != 0:
-        print("Failed to run dot with this input file content:")
-        print("\n".join(dot))
-        print("dot stdout:")
-        print(child.stdout)
-        print("dot stderr:")
-        print(child.stderr)
+    # Laying out the graph is by far the slowest step, so reuse the SVG from
+    # an earlier run with exactly the same dot source if there is one.
+    path = os.path.join(svg_cache_dir(), f"{dot_source_hash(dot)}.svg")
+    if is_fresh(path, SVG_CACHE_TTL):
+        display_svg(path)
+        return
+
+    # Render outside the cache, so a failed run of dot leaves nothing behind
+    # in it, and so the diagram can still be shown if the cache isn't
+    # writable.
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rendered_path = os.path.join(tmp_dir, "diagram.svg")
+        error = render_svg(dot, rendered_path)
+        if error is not None:
+            print("Failed to run dot with this input:")
+            print("\n".join(dot))
+            print("dot stderr:")
+            print(error)
+            return
+        display_svg(store_in_svg_cache(rendered_path, path) or rendered_path)
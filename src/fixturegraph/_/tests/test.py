@@ -1,8 +1,16 @@
 from typing import NamedTuple
 
 from dataclasses import dataclass
+import io
+import os
+import subprocess
+import time
+
+import pytest
+
 import fixturegraph
-from fixturegraph._.diagram import combine_arrows, diagram, make_arrows
+from fixturegraph._.diagram import (SVG_CACHE_TTL, Arrow, combine_arrows, diagram,
+                                    get_attrs, make_arrows)
 
 
 @dataclass
@@ -202,6 +210,177 @@ def test_combining_arrows_from_parent_child_relationship():
     ]
 
 
+def test_entities_listed_twice_give_no_duplicate_arrows():
+    child1 = Child("child1", matching="spam")
+    parent = Parent("ref", [child1], matching="spam")
+    entities = [parent, child1, parent, child1]
+    config = fixturegraph.Configuration(
+        id_attrs={
+            Parent: "reference",
+            Child: "id",
+        },
+        attrs_with_child_refs={
+            Parent: ["children"],
+        },
+    )
+    arrows = make_arrows(config, entities)
+    assert list(map(str, sorted(arrows))) == [
+        'child_child1 (Child) -> parent_ref (Parent) on attr matching matched on spam',
+        'parent_ref (Parent) -> child_child1 (Child) on attr children_0',
+        'parent_ref (Parent) -> child_child1 (Child) on attr matching matched on spam',
+    ]
+
+
+def test_ids_from_getter_methods_and_tuples():
+
+    class Order:
+
+        def __init__(self, reference, sku):
+            self.reference = reference
+            self.sku = sku
+
+        def get_aggregate_id(self):
+            return self.reference
+
+    class Stock(NamedTuple):
+        key: tuple
+        sku: str
+
+    entities = [Order("123", sku="abc"), Stock(key=("wh1", "abc"), sku="abc")]
+    config = fixturegraph.Configuration(id_attrs={
+        Order: "get_aggregate_id",
+        Stock: "key",
+    }, )
+    dot = diagram(config, entities)
+    assert dot == [
+        'order_123',
+        'stock_wh1_abc',
+        'order_123->stock_wh1_abc [ label= <key_1<br/>sku> dir="both" ]',
+    ]
+
+
+def test_id_held_as_callable_instance_attribute():
+
+    class Question:
+
+        def __init__(self, ident):
+            self.ident = ident
+
+    config = fixturegraph.Configuration(id_attrs={Question: "ident"}, )
+    dot = diagram(config, [Question(lambda: "q1"), Question("q2")])
+    assert dot == [
+        'question_q1',
+        'question_q2',
+    ]
+
+
+def test_temporary_children_from_properties():
+    # Each access builds a new child that is freed straight away, so later
+    # children may reuse its id: names must not be remembered by id for them.
+
+    class Kid:
+        __slots__ = ("id", )
+
+        def __init__(self, id):
+            self.id = id
+
+    class Maker:
+
+        def __init__(self, reference):
+            self.reference = reference
+
+        @property
+        def kid(self):
+            return Kid(self.reference + "a")
+
+        @property
+        def kid2(self):
+            return Kid(self.reference + "b")
+
+    entities = [Maker(f"m{i}") for i in range(3)]
+    config = fixturegraph.Configuration(
+        id_attrs={
+            Maker: "reference",
+            Kid: "id",
+        },
+        attrs_with_child_refs={
+            Maker: ["kid", "kid2"],
+        },
+    )
+    dot = diagram(config, entities)
+    assert dot == [
+        'maker_m0',
+        'maker_m1',
+        'maker_m2',
+        'maker_m0->kid_m0a [ label= <kid> ]',
+        'maker_m0->kid_m0b [ label= <kid2> ]',
+        'maker_m1->kid_m1a [ label= <kid> ]',
+        'maker_m1->kid_m1b [ label= <kid2> ]',
+        'maker_m2->kid_m2a [ label= <kid> ]',
+        'maker_m2->kid_m2b [ label= <kid2> ]',
+    ]
+
+
+def test_inferring_arrows_from_properties():
+
+    class Order:
+
+        def __init__(self, a, b):
+            self.a = a
+            self.b = b
+
+        @property
+        def order_ref(self):
+            return self.a + "-" + self.b
+
+    class Shipment(NamedTuple):
+        ref: str
+
+        @property
+        def order_ref(self):
+            return "x-y"
+
+    entities = [Order("x", "y"), Shipment(ref="s1")]
+    config = fixturegraph.Configuration(id_attrs={
+        Order: "order_ref",
+        Shipment: "ref",
+    }, )
+    arrows = make_arrows(config, entities)
+    assert list(map(str, sorted(arrows))) == [
+        'order_x_y (Order) -> shipment_s1 (Shipment) on attr order_ref matched on x-y',
+        'shipment_s1 (Shipment) -> order_x_y (Order) on attr order_ref matched on x-y',
+    ]
+
+
+def test_mixed_sequences_are_judged_by_their_first_item():
+    # Sequences are assumed to be homogeneous, so only the first item decides
+    # whether a sequence is indexed; non-string items are then skipped.
+    @dataclass
+    class Tagged:
+        ref: str
+        tags: list
+
+    assert get_attrs({}, Tagged(ref="t1", tags=["a", 1])) == [
+        ("ref", "t1"),
+        ("tags_0", "a"),
+    ]
+    assert get_attrs({}, Tagged(ref="t2", tags=[Child("c"), "a"])) == [
+        ("ref", "t2"),
+    ]
+
+
+@pytest.mark.parametrize("guessed, value", [(True, None), (False, "1")])
+def test_arrow_guessed_only_with_value(guessed, value):
+    with pytest.raises(AssertionError):
+        Arrow.make(src_name="widget_1",
+                   dst_name="lozenge_1",
+                   key="ref",
+                   value=value,
+                   guessed=guessed,
+                   src_type=Widget,
+                   dst_type=Lozenge)
+
+
 def test_readme_example():
 
     class SaleOrder(NamedTuple):
@@ -223,3 +402,131 @@ def test_readme_example():
         'saleorder_123',
         'product_abc->saleorder_123 [ label= <sku> dir="both" ]',
     ]
+
+
+class FakeDotProcess:
+
+    def __init__(self, output_path, fail):
+        self.stdin = io.StringIO()
+        self.returncode = None
+        self._output_path = output_path
+        self._fail = fail
+
+    def communicate(self):
+        if self._fail:
+            self.returncode = 1
+            return None, "syntax error"
+        with open(self._output_path, "w") as fh:
+            fh.write("<svg/>")
+        self.returncode = 0
+        return None, ""
+
+
+class FakeTools:
+    # Stands in for the dot and display programs.
+
+    def __init__(self):
+        self.dot_runs = 0
+        self.dot_fails = False
+        self.display_returncode = 0
+        self.displayed = []
+        self.missing = False
+
+    def popen(self, args, **kwargs):
+        if self.missing:
+            raise FileNotFoundError(2, "No such file or directory", args[0])
+        self.dot_runs += 1
+        return FakeDotProcess(args[-1], self.dot_fails)
+
+    def run(self, args, **kwargs):
+        if self.missing:
+            raise FileNotFoundError(2, "No such file or directory", args[0])
+        assert os.path.exists(args[1])
+        self.displayed.append(args[1])
+        return subprocess.CompletedProcess(args, self.display_returncode, "", "oops")
+
+
+@pytest.fixture
+def tools(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+    tools = FakeTools()
+    monkeypatch.setattr(subprocess, "Popen", tools.popen)
+    monkeypatch.setattr(subprocess, "run", tools.run)
+    return tools
+
+
+def show_widget_diagram():
+    config = fixturegraph.Configuration(id_attrs={
+        Widget: "ref",
+        Lozenge: "ref",
+    }, )
+    fixturegraph.show_diagram(
+        config, [Widget(ref="1", lozenge="1", part="1"),
+                 Lozenge(ref="1", widget="1")])
+
+
+def test_show_diagram_reuses_cached_svg(tools, tmp_path):
+    show_widget_diagram()
+    show_widget_diagram()
+    assert tools.dot_runs == 1
+    cached = list((tmp_path / "fixturegraph").iterdir())
+    assert [p.suffix for p in cached] == [".svg"]
+    assert tools.displayed == [str(cached[0])] * 2
+
+
+def test_show_diagram_rerenders_expired_svg(tools, tmp_path):
+    show_widget_diagram()
+    [cached] = (tmp_path / "fixturegraph").iterdir()
+    expired = time.time() - SVG_CACHE_TTL - 1
+    os.utime(cached, (expired, expired))
+    show_widget_diagram()
+    assert tools.dot_runs == 2
+    assert time.time() - cached.stat().st_mtime < SVG_CACHE_TTL
+
+
+def test_show_diagram_prunes_expired_cache_entries(tools, tmp_path):
+    cache_dir = tmp_path / "fixturegraph"
+    cache_dir.mkdir()
+    old = cache_dir / "old.svg"
+    old.write_text("<svg/>")
+    expired = time.time() - SVG_CACHE_TTL - 1
+    os.utime(old, (expired, expired))
+    show_widget_diagram()
+    assert not old.exists()
+    assert len(list(cache_dir.iterdir())) == 1
+
+
+def test_show_diagram_failed_dot_leaves_cache_empty(tools, tmp_path, capsys):
+    tools.dot_fails = True
+    show_widget_diagram()
+    assert not (tmp_path / "fixturegraph").exists()
+    assert tools.displayed == []
+    out = capsys.readouterr().out
+    assert "Failed to run dot with this input:" in out
+    assert "syntax error" in out
+
+
+def test_show_diagram_reports_missing_programs(tools, tmp_path, capsys):
+    tools.missing = True
+    show_widget_diagram()
+    assert not (tmp_path / "fixturegraph").exists()
+    assert "Failed to run dot with this input:" in capsys.readouterr().out
+
+
+def test_show_diagram_reports_display_failure(tools, capsys):
+    tools.display_returncode = 1
+    show_widget_diagram()
+    out = capsys.readouterr().out
+    assert "Failed to run display" in out
+    assert "oops" in out
+
+
+def test_show_diagram_without_usable_cache(tools, tmp_path, monkeypatch):
+    # A file where the cache directory should be makes the cache unusable.
+    not_a_dir = tmp_path / "not_a_dir"
+    not_a_dir.write_text("")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(not_a_dir))
+    show_widget_diagram()
+    assert tools.dot_runs == 1
+    assert len(tools.displayed) == 1
+    assert not tools.displayed[0].startswith(str(not_a_dir))